@@ -1,13 +1,155 @@
 import sys, json
+import signal
 
+from multiprocessing import Pool, TimeoutError
 from optparse import make_option
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 
 from boundaries.models import BoundarySet, Boundary
 
+MIN_RATIO = .001
+
+# psycopg2 only allows named (server-side) cursors inside a transaction, but
+# Django 1.6+ runs in autocommit mode.
+try:
+	atomic = transaction.atomic # Django 1.6+
+except AttributeError:
+	atomic = transaction.commit_on_success
+
+# Joins the two boundary sets on ST_Intersects so that PostGIS can use the
+# spatial index on shape, and computes the areas server-side. The areas of the
+# boundaries themselves are computed in a CTE once per boundary that is part
+# of a candidate pair, rather than once per pair or for the whole of both
+# sets. ST_Intersection dominates the running time, so it is skipped when one
+# shape covers the other and the area of the intersection is simply the area
+# of the smaller shape.
+#
+# Shapefiles often contain invalid polygons, on which ST_Intersection (and
+# ST_Covers and ST_CoveredBy) can raise an error that would abort the whole
+# query. The intersection area of a pair with an invalid shape is left NULL,
+# and is computed in Python instead (see intersection_area).
+#
+# Overlaps that are less than MIN_RATIO of the area of either of the shapes are
+# probably not true overlaps, and are filtered out before they leave the
+# database.
+INTERSECTIONS_SQL_TEMPLATE = """
+WITH candidates AS (
+	SELECT a.id AS a_id, b.id AS b_id
+	FROM %(table)s a
+	JOIN %(table)s b ON ST_Intersects(a.shape, b.shape)
+	WHERE a.set_id = %%(set_a)s AND b.set_id = %%(set_b)s %(a_slugs_filter)s
+), areas AS (
+	SELECT id, ST_Area(shape) AS area, ST_IsValid(shape) AS valid
+	FROM %(table)s
+	WHERE id IN (SELECT a_id FROM candidates UNION SELECT b_id FROM candidates)
+), pairs AS (
+	SELECT a.id AS a_id, a.slug AS a_slug, a_areas.area AS a_area,
+		b.id AS b_id, b.slug AS b_slug, b_areas.area AS b_area,
+		CASE
+			WHEN NOT (a_areas.valid AND b_areas.valid) THEN NULL
+			WHEN ST_CoveredBy(a.shape, b.shape) THEN a_areas.area
+			WHEN ST_Covers(a.shape, b.shape) THEN b_areas.area
+			ELSE ST_Area(ST_Intersection(a.shape, b.shape))
+		END AS int_area
+	FROM candidates
+	JOIN %(table)s a ON a.id = candidates.a_id
+	JOIN %(table)s b ON b.id = candidates.b_id
+	JOIN areas a_areas ON a_areas.id = candidates.a_id
+	JOIN areas b_areas ON b_areas.id = candidates.b_id
+)
+SELECT a_id, a_slug, a_area, b_id, b_slug, b_area, int_area
+FROM pairs
+WHERE int_area IS NULL OR (int_area >= %%(min_ratio)s * a_area
+	AND int_area >= %%(min_ratio)s * b_area AND int_area > 0)
+ORDER BY a_slug, b_slug
+"""
+INTERSECTIONS_SQL = INTERSECTIONS_SQL_TEMPLATE % {
+	"table": Boundary._meta.db_table,
+	"a_slugs_filter": "",
+}
+# Restricted to some of the boundaries in the first set, for use by workers.
+INTERSECTIONS_CHUNK_SQL = INTERSECTIONS_SQL_TEMPLATE % {
+	"table": Boundary._meta.db_table,
+	"a_slugs_filter": "AND a.slug = ANY(%(a_slugs)s)",
+}
+
+def intersection_area(a_id, a_slug, a_area, b_id, b_slug, b_area):
+	"""
+	Returns the area of intersection of two boundaries computed with GEOS, or
+	None if the shapes don't truly overlap or can't be intersected, in which
+	case the error is reported on stderr.
+	"""
+	shapes = dict(Boundary.objects.filter(id__in=(a_id, b_id)).values_list('id', 'shape'))
+	try:
+		geometry = shapes[a_id].intersection(shapes[b_id])
+	except Exception as e:
+		sys.stderr.write("%s/%s: %s\n" % (a_slug, b_slug, unicode(e)))
+		return None
+
+	int_area = geometry.area
+	if geometry.empty or int_area < MIN_RATIO * a_area or int_area < MIN_RATIO * b_area:
+		return None
+	return int_area
+
+def intersecting_pairs(set_a, set_b, a_slugs=None):
+	"""
+	Yields a tuple of (a_id, a_slug, a_area, b_id, b_slug, b_area, int_area)
+	for every pair of overlapping boundaries from the two sets, streamed from
+	a server-side cursor. If a_slugs is given, only those boundaries from the
+	first set are considered.
+	"""
+	params = { "set_a": set_a, "set_b": set_b, "min_ratio": MIN_RATIO }
+	if a_slugs is None:
+		sql = INTERSECTIONS_SQL
+	else:
+		sql = INTERSECTIONS_CHUNK_SQL
+		params["a_slugs"] = list(a_slugs)
+
+	with atomic():
+		connection.cursor() # ensure the connection is open
+		cursor = connection.connection.cursor(name="compute_intersections")
+		cursor.itersize = 2000
+		try:
+			cursor.execute(sql, params)
+			for row in cursor:
+				if row[6] is None:
+					int_area = intersection_area(*row[:6])
+					if int_area is None:
+						continue
+					row = row[:6] + (int_area,)
+				yield row
+		finally:
+			cursor.close()
+
+def intersecting_pairs_chunk(args):
+	# Run in a worker process. Generators can't be sent back to the parent.
+	return list(intersecting_pairs(*args))
+
+def ignore_sigint():
+	# Run when a worker process starts. Ctrl-C is handled by the parent, which
+	# terminates the pool; a worker killed by KeyboardInterrupt would instead
+	# lose its chunk and be replaced.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def pool_results(results):
+	"""
+	Yields the rows of each chunk from a Pool.imap iterator, in order. The
+	iterator is polled with a timeout because, in Python 2, waiting on it
+	without one blocks KeyboardInterrupt.
+	"""
+	while True:
+		try:
+			rows = results.next(1)
+		except TimeoutError:
+			continue
+		except StopIteration:
+			return
+		for row in rows:
+			yield row
+
 class Command(BaseCommand):
 	help = 'Create a report of the area of intersection of every pair of boundaries from two boundary sets specified by their slug.'
 	args = 'boundaryset1 boundaryset1'
@@ -17,6 +159,8 @@ class Command(BaseCommand):
 			help='Choose an output format: csv, json.'),
 		make_option('-m', '--metadata', action='store_true', dest='include_metadata', default=False,
 			help='Includes the original shapefile metadata in the output.'),
+		make_option('-p', '--processes', action='store', type='int', dest='processes', default=1,
+			help='Split the boundaries in the first set across this many processes.'),
 	)
 
 	def handle(self, *args, **options):
@@ -30,37 +174,55 @@ class Command(BaseCommand):
 		if options["format"] == "csv":
 			print bset_a.slug, "area_1", bset_b.slug, "area_2", "area_intersection", "pct_of_1", "pct_of_2"
 		elif options["format"] == "json":
-			output = [ ]
+			# Records are written as they are computed, rather than collected
+			# into one list, to keep memory use flat on large sets.
+			sys.stdout.write("[")
+			first = True
 
-		# For each boundary in the first set...
-		for a_slug in bset_a.boundaries.order_by("slug").values_list('slug', flat=True):
-			a_bdry = bset_a.boundaries.get(slug=a_slug)
-			a_area = a_bdry.shape.area
+			# The shapes are by far the largest columns, and the areas come
+			# from the intersection query, so only fetch what is output.
+			fields = ['external_id', 'name', 'centroid', 'extent']
+			if options["include_metadata"]:
+				fields.append('metadata')
 
-			# Find each intersecting boundary in the second set...
-			for b_bdry in bset_b.boundaries\
-				.filter(shape__intersects=a_bdry.shape):
+			# The pairs are ordered by the slug of the boundary from the first
+			# set, so that set's models are built one at a time as the pairs
+			# are read, in the same order, instead of all being kept in a dict.
+			# Boundaries from the second set are looked up in any order.
+			a_boundaries = bset_a.boundaries.order_by("slug").only(*fields).iterator()
+			a_bdry = None
+			b_boundaries = dict((b.id, b) for b in bset_b.boundaries.only(*fields))
 
-				try:
-					geometry = a_bdry.shape.intersection(b_bdry.shape)
-				except Exception as e:
-					sys.stderr.write("%s/%s: %s\n" % (a_slug, b_bdry.slug, unicode(e)))
-					continue
-					
-				int_area = geometry.area
-				if geometry.empty: continue
+		if options["processes"] > 1:
+			# Give each process several chunks of the first set so that the work
+			# is balanced. Chunks are in slug order, and imap returns results in
+			# the order of its input, so the output is the same as in serial.
+			a_slugs = list(bset_a.boundaries.order_by("slug").values_list("slug", flat=True))
+			chunk_size = len(a_slugs) // (options["processes"] * 4) + 1
+			chunks = [(bset_a.slug, bset_b.slug, a_slugs[i:i + chunk_size])
+				for i in range(0, len(a_slugs), chunk_size)]
 
-				b_area = b_bdry.shape.area
-
-				# Skip overlaps that are less than .1% of the area of either of the shapes.
-				# These are probably not true overlaps.
-				if int_area/a_area < .001 or int_area/b_area < .001:
-					continue
+			# Each process must open its own connection to the database.
+			connection.close()
+			pool = Pool(processes=options["processes"], initializer=ignore_sigint)
+			pairs = pool_results(pool.imap(intersecting_pairs_chunk, chunks))
+		else:
+			pool = None
+			pairs = intersecting_pairs(bset_a.slug, bset_b.slug)
 
+		try:
+			# For each overlapping pair of boundaries from the two sets...
+			for a_id, a_slug, a_area, b_id, b_slug, b_area, int_area in pairs:
 				if options["format"] == "csv":
-					print a_slug, a_area, b_bdry.slug, b_area, int_area, int_area/a_area, int_area/b_area
+					print a_slug, a_area, b_slug, b_area, int_area, int_area/a_area, int_area/b_area
 				elif options["format"] == "json":
-					output.append({
+					while a_bdry is None or a_bdry.id != a_id:
+						try:
+							a_bdry = next(a_boundaries)
+						except StopIteration:
+							raise CommandError("Boundary %s/%s was not found in slug order; the intersections and boundaries queries disagree on the order of slugs." % (bset_a.slug, a_slug))
+					b_bdry = b_boundaries[b_id]
+					record = {
 						"area": int_area,
 						bset_a.slug: {
 							"id": a_bdry.external_id,
@@ -74,17 +236,29 @@ class Command(BaseCommand):
 						bset_b.slug: {
 							"id": b_bdry.external_id,
 							"name": b_bdry.name,
-							"slug": b_bdry.slug,
+							"slug": b_slug,
 							"centroid": tuple(b_bdry.centroid),
 							"extent": b_bdry.extent,
 							"area": b_area,
 							"ratio": int_area/b_area,
 						},
-					})
+					}
 					if options["include_metadata"]:
-						output[-1][bset_a.slug]["metadata"] = a_bdry.metadata
-						output[-1][bset_b.slug]["metadata"] = b_bdry.metadata
-				
+						record[bset_a.slug]["metadata"] = a_bdry.metadata
+						record[bset_b.slug]["metadata"] = b_bdry.metadata
+
+					# Indent each record as if it were an item of an indented list,
+					# with the same separator that json.dumps uses between items.
+					sys.stdout.write("\n  " if first else ", \n  ")
+					sys.stdout.write(json.dumps(record, sort_keys=True, indent=2).replace("\n", "\n  "))
+					first = False
+		finally:
+			if pool:
+				# All the results have been read at this point, unless a worker
+				# raised or the command was interrupted, in which case the
+				# remaining workers must not be left running.
+				pool.terminate()
+				pool.join()
+
 		if options["format"] == "json":
-			print json.dumps(output, sort_keys=True, indent=2)
-	
+			print "]" if first else "\n]"